@@ -1,23 +1,80 @@
-import ast
+import time
+
+# Start of this script run, used by the startup/rerun profile
+SCRIPT_START = time.perf_counter()
+
+from collections import namedtuple
+from contextlib import closing, contextmanager
+import hashlib
+import heapq
+import itertools
 import json
+import logging
 import re
-from openai import OpenAI
+import sys
+import threading
 import streamlit as st
 import os
-from urllib.parse import urlparse
-import shelve
-import requests
+from urllib.parse import parse_qs, urlparse
+import sqlite3
+import uuid
+import zlib
 import random
-import streamlit.components.v1 as components
+# openai, requests, shelve and streamlit.components are imported where they are used
 
 
+logger = logging.getLogger(__name__)
+
 # Constants
 USER_AVATAR = "👤"
 BOT_AVATAR = "🤖"
 
+# Create clients, load history and the Dialogflow widget only when first needed
+LAZY_INIT = os.getenv("LAZY_INIT", "false").lower() in ("1", "true", "yes")
+
+# Phase timings of the current script run; Streamlit re-executes the script so this starts empty
+RERUN_PROFILE = {}
+
+
+@contextmanager
+def profile_step(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        RERUN_PROFILE[name] = time.perf_counter() - start
+
+
 # Initialize OpenAI client
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
+
+
+@st.cache_resource
+def get_openai_client():
+    from openai import OpenAI
+    # Retries (429s, connection errors and 5xx) are handled by the request scheduler
+    # so every attempt counts against the rate limits
+    return OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+
+@st.cache_resource
+def get_http_session():
+    """
+    Process-wide session for GraphQL calls, so connections are reused across reruns.
+
+    Its urllib3 connection pool is thread-safe for these stateless POSTs; cookies
+    are refused so nothing from one user's response leaks into another's request.
+    """
+    from http.cookiejar import DefaultCookiePolicy
+    import requests
+
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+if not LAZY_INIT:
+    get_openai_client()
 
 # Set default OpenAI model
 if "openai_model" not in st.session_state:
@@ -26,6 +83,80 @@ if "openai_model" not in st.session_state:
 # GraphQL endpoint
 GRAPHQL_URL = "https://www.shyaway.com/graphql"
 
+# Send a sha256 hash of the query instead of the full text (automatic persisted queries)
+GRAPHQL_PERSISTED_QUERIES = os.getenv("GRAPHQL_PERSISTED_QUERIES", "false").lower() in ("1", "true", "yes")
+
+# Constant query document, values are sent as GraphQL variables
+PRODUCT_LIST_QUERY = """
+query getProductList(
+  $urlKey: String!,
+  $searchQuery: String,
+  $sortBy: String!,
+  $sortDirection: String!,
+  $page: Int!,
+  $limit: Int!
+) {
+  getProductList(
+    urlKey: $urlKey,
+    searchQuery: $searchQuery,
+    sortBy: $sortBy,
+    sortDirection: $sortDirection,
+    page: $page,
+    limit: $limit
+  ) {
+    status
+    message
+    data {
+      items {
+        product_link
+        sku
+        image {
+          url
+          width
+          height
+        }
+        offer_data {
+          label
+          color
+        }
+      }
+    }
+  }
+}
+"""
+PRODUCT_LIST_QUERY_HASH = hashlib.sha256(PRODUCT_LIST_QUERY.encode("utf-8")).hexdigest()
+
+
+PERSISTED_QUERY_ERRORS = {
+    "PERSISTED_QUERY_NOT_FOUND": "not_found",
+    "PersistedQueryNotFound": "not_found",
+    "PERSISTED_QUERY_NOT_SUPPORTED": "not_supported",
+    "PersistedQueryNotSupported": "not_supported",
+}
+
+
+def persisted_query_error(response):
+    """
+    Check whether the server refused a hash-only persisted query.
+
+    Returns:
+        str: "not_found" when it needs the query text once, "not_supported" when
+            it has no persisted queries at all, or None for any other response.
+    """
+    try:
+        result = response.json()
+    except ValueError:
+        return None
+    if not isinstance(result, dict):
+        return None
+    for error in result.get("errors") or []:
+        code = (error.get("extensions") or {}).get("code", "")
+        kind = PERSISTED_QUERY_ERRORS.get(code) or PERSISTED_QUERY_ERRORS.get(error.get("message"))
+        if kind:
+            return kind
+    return None
+
+
 # Function to fetch product list
 def get_product_list(
     url_key, 
@@ -34,7 +165,8 @@ def get_product_list(
     sort_direction="asc", 
     page=1, 
     limit=4, 
-    token=None
+    token=None,
+    persisted=None
 ):
     """
     Fetch the product list from the GraphQL API.
@@ -47,73 +179,589 @@ def get_product_list(
         page (int): Page number for pagination.
         limit (int): Number of items per page.
         token (str, optional): Authorization token for API access.
+        persisted (bool, optional): Send the query as an automatic persisted query.
+            Defaults to GRAPHQL_PERSISTED_QUERIES.
 
     Returns:
         dict: Parsed response containing the product list or an error message.
     """
-    # Define the GraphQL query
-    query = f"""
-    {{
-      getProductList(
-        urlKey: "{url_key}",
-        searchQuery: {f'"{search_query}"' if search_query else "null"},
-        sortBy: "{sort_by}",
-        sortDirection: "{sort_direction}",
-        page: {page},
-        limit: {limit}
-      ) {{
-        status
-        message
-        data {{
-          items {{
-            product_link
-            sku
-            image {{
-              url
-              width
-              height
-            }}
-            offer_data{{
-              label
-              color
-          }}
-          }}
-        }}
-      }}
-    }}
-    """
+    if persisted is None:
+        persisted = GRAPHQL_PERSISTED_QUERIES
+
+    variables = {
+        "urlKey": url_key,
+        "searchQuery": search_query or None,
+        "sortBy": sort_by,
+        "sortDirection": sort_direction,
+        "page": page,
+        "limit": limit,
+    }
+    payload = {"operationName": "getProductList", "variables": variables}
 
     # Prepare headers
     headers = {"Content-Type": "application/json"}
     if token:
         headers["Authorization"] = f"Bearer {token}"
 
+    if persisted:
+        payload["extensions"] = {
+            "persistedQuery": {"version": 1, "sha256Hash": PRODUCT_LIST_QUERY_HASH}
+        }
+        # Try the hash alone first, the server only needs the text the first time
+        response = get_http_session().post(GRAPHQL_URL, json=payload, headers=headers)
+        # Some servers answer these with a 400, so look at the body whatever the status
+        rejected = persisted_query_error(response)
+        if rejected is None:
+            return parse_graphql_response(response)
+        if rejected == "not_supported":
+            # Without persisted query support the extension can be refused again
+            del payload["extensions"]
+
     # Send the request
-    response = requests.post(GRAPHQL_URL, json={"query": query}, headers=headers)
+    payload["query"] = PRODUCT_LIST_QUERY
+    response = get_http_session().post(GRAPHQL_URL, json=payload, headers=headers)
+    return parse_graphql_response(response)
+
 
+def parse_graphql_response(response):
     # Handle the response
     if response.status_code == 200:
-        return response.json()
+        try:
+            return response.json()
+        except ValueError:
+            # A proxy or maintenance page can answer 200 with HTML
+            return {"error": "Invalid JSON response", "details": response.text}
     else:
         return {"error": f"HTTP {response.status_code}", "details": response.text}
 
-# Function to load chat history from shelve file
-def load_chat_history():
-    with shelve.open("chat_history") as db:
-        return db.get("messages", [])
+# OpenAI rate limits per model (tokens and requests per minute)
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+# Completion tokens reserved for a request that does not set max_tokens
+OPENAI_COMPLETION_ESTIMATE = 400
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """
+    Roughly estimate the tokens a chat completion will consume.
+
+    Uses ~4 characters per token for the prompt plus the per-message overhead,
+    and reserves max_tokens (or OPENAI_COMPLETION_ESTIMATE) for the answer.
+    """
+    prompt_tokens = 3
+    for message in messages:
+        prompt_tokens += 4 + len(message.get("content") or "") // 4
+    return prompt_tokens + (max_tokens or OPENAI_COMPLETION_ESTIMATE)
+
+
+def retry_after_seconds(error, attempt):
+    """Read the wait time from a 429 response, falling back to exponential backoff."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return min(60.0, 2 ** attempt)
+
+
+def is_transient_status(status_code):
+    return status_code in (408, 409) or status_code >= 500
+
+
+class TokenBucket:
+    """Budget of `capacity` units that refills continuously over one minute."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.level = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.level = min(self.capacity, self.level + elapsed * self.capacity / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # A request bigger than the whole bucket only waits for a full bucket
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60.0 / self.capacity
+
+
+class RequestScheduler:
+    """
+    Central gate for OpenAI chat completions shared by all sessions.
+
+    Keeps a token and a request bucket per model, lets interactive questions
+    jump ahead of queued bulk questions, retries 429 responses after the
+    server's retry-after delay and retries transient connection and server
+    errors with exponential backoff.
+    """
+
+    INTERACTIVE = 0
+    BULK = 1
+
+    def __init__(self, tpm_limit, rpm_limit, max_retries):
+        self.tpm_limit = tpm_limit
+        self.rpm_limit = rpm_limit
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._queues = {}  # model -> heap of (priority, seq) tickets
+        self._buckets = {}  # model -> (token bucket, request bucket)
+        self._blocked_until = {}  # model -> monotonic time set by a 429
+
+    def _model_state(self, model):
+        if model not in self._buckets:
+            self._buckets[model] = (TokenBucket(self.tpm_limit), TokenBucket(self.rpm_limit))
+            self._queues[model] = []
+        return self._queues[model], self._buckets[model]
+
+    def _acquire(self, model, tokens, priority):
+        with self._cond:
+            queue, (token_bucket, request_bucket) = self._model_state(model)
+            ticket = (priority, next(self._seq))
+            heapq.heappush(queue, ticket)
+            self._cond.notify_all()
+            try:
+                while True:
+                    if queue[0] != ticket:
+                        self._cond.wait()
+                        continue
+                    now = time.monotonic()
+                    token_bucket.refill(now)
+                    request_bucket.refill(now)
+                    wait = max(
+                        token_bucket.wait_time(tokens),
+                        request_bucket.wait_time(1),
+                        self._blocked_until.get(model, 0) - now,
+                    )
+                    if wait <= 0:
+                        token_bucket.level -= tokens
+                        request_bucket.level -= 1
+                        return
+                    self._cond.wait(wait)
+            finally:
+                queue.remove(ticket)
+                heapq.heapify(queue)
+                self._cond.notify_all()
+
+    def _settle(self, model, estimated, actual):
+        # Give back (or charge) the difference between the estimate and real usage
+        with self._cond:
+            _, (token_bucket, _) = self._model_state(model)
+            token_bucket.level = min(token_bucket.capacity, token_bucket.level + estimated - actual)
+            self._cond.notify_all()
+
+    def _back_off(self, model, seconds):
+        with self._cond:
+            until = time.monotonic() + seconds
+            self._blocked_until[model] = max(self._blocked_until.get(model, 0), until)
+            self._cond.notify_all()
+
+    def create(self, client, messages, model, priority=BULK, **kwargs):
+        from openai import APIConnectionError, APIStatusError, RateLimitError
+
+        tokens = estimate_tokens(messages, kwargs.get("max_tokens"))
+        for attempt in range(self.max_retries + 1):
+            self._acquire(model, tokens, priority)
+            try:
+                response = client.chat.completions.create(model=model, messages=messages, **kwargs)
+            except RateLimitError as error:
+                # A rejected request used no tokens, give its estimate back
+                self._settle(model, tokens, 0)
+                # An exhausted quota will not recover by waiting
+                if attempt == self.max_retries or getattr(error, "code", None) == "insufficient_quota":
+                    raise
+                self._back_off(model, retry_after_seconds(error, attempt))
+                continue
+            except (APIConnectionError, APIStatusError) as error:
+                # Connection errors, timeouts, 408/409 and 5xx are worth retrying, like the SDK does
+                self._settle(model, tokens, 0)
+                transient = isinstance(error, APIConnectionError) or is_transient_status(error.status_code)
+                if attempt == self.max_retries or not transient:
+                    raise
+                time.sleep(retry_after_seconds(error, attempt))
+                continue
+            except BaseException:
+                self._settle(model, tokens, 0)
+                raise
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                self._settle(model, tokens, usage.total_tokens)
+            return response
+
+
+@st.cache_resource
+def get_request_scheduler():
+    # Cached as a resource so every session and rerun shares the same budgets
+    return RequestScheduler(OPENAI_TPM_LIMIT, OPENAI_RPM_LIMIT, OPENAI_MAX_RETRIES)
+
+
+def create_chat_completion(messages, model=None, interactive=None):
+    """
+    Run a chat completion through the shared request scheduler.
+
+    Args:
+        messages (list): Chat messages for the request.
+        model (str, optional): Model name. Defaults to the session model.
+        interactive (bool, optional): Schedule ahead of bulk questions.
+            Defaults to True when the session is in "single" QA mode.
+
+    Returns:
+        ChatCompletion: The OpenAI response.
+    """
+    if model is None:
+        model = st.session_state["openai_model"]
+    if interactive is None:
+        interactive = st.session_state.get("qa_state") == "single"
+    priority = RequestScheduler.INTERACTIVE if interactive else RequestScheduler.BULK
+    return get_request_scheduler().create(get_openai_client(), messages, model, priority)
+
+
+# Messages kept in memory per session before older turns are dropped from session state
+MAX_MESSAGES_IN_MEMORY = int(os.getenv("MAX_MESSAGES_IN_MEMORY", "40"))
+
+# Chat history is sharded by user id over several SQLite files
+CHAT_HISTORY_DIR = os.getenv("CHAT_HISTORY_DIR", "chat_history_shards")
+CHAT_HISTORY_SHARDS = int(os.getenv("CHAT_HISTORY_SHARDS", "8"))
+# History written by older versions to a single shelve file, imported as this user
+LEGACY_HISTORY_FILE = "chat_history"
+LEGACY_USER_ID = "legacy"
+
+
+class ChatMessage:
+    """
+    Compact chat history record.
+
+    Token usage is kept as three ints rather than the OpenAI usage object, and
+    records are stored as plain dicts so the history can be read without this module.
+    """
+
+    __slots__ = (
+        "role", "content", "qno", "category", "product", "cascade",
+        "prompt_tokens", "completion_tokens", "total_tokens", "seq",
+    )
 
+    def __init__(self, role, content, qno=None, category=None, product=None, cascade=None, usage=None, seq=None):
+        self.seq = seq
+        self.role = role
+        self.content = content
+        self.qno = qno
+        self.category = category
+        self.product = product
+        self.cascade = cascade
+        if usage is None:
+            self.prompt_tokens = self.completion_tokens = self.total_tokens = None
+        elif isinstance(usage, (tuple, list)):
+            self.prompt_tokens, self.completion_tokens, self.total_tokens = usage
+        else:
+            self.prompt_tokens = usage.prompt_tokens
+            self.completion_tokens = usage.completion_tokens
+            self.total_tokens = usage.total_tokens
+
+    @property
+    def has_usage(self):
+        return self.total_tokens is not None
+
+    def to_dict(self):
+        record = {"role": self.role, "content": self.content, "category": self.category}
+        if self.qno is not None:
+            record["Qno"] = self.qno
+        if self.role == "assistant":
+            record["product"] = self.product
+        if self.cascade:
+            record["cascade"] = self.cascade
+        if self.has_usage:
+            record["usage"] = (self.prompt_tokens, self.completion_tokens, self.total_tokens)
+        return record
+
+    @classmethod
+    def from_dict(cls, record):
+        # Older records hold the OpenAI usage object itself
+        return cls(
+            record.get("role"),
+            record.get("content"),
+            qno=record.get("Qno"),
+            category=record.get("category"),
+            product=record.get("product"),
+            cascade=record.get("cascade"),
+            usage=record.get("usage") or None,
+        )
 
-# Function to save chat history to shelve file
-def save_chat_history(messages):
-    with shelve.open("chat_history") as db:
-        db["messages"] = messages
+
+def summarize_messages(messages):
+    """Counters shown in the sidebar, kept for archived messages as well."""
+    cascaded = [msg for msg in messages if msg.cascade]
+    return {
+        "messages": len(messages),
+        "questions": sum(1 for msg in messages if msg.role == "user"),
+        "prompt_tokens": sum(msg.prompt_tokens for msg in messages if msg.has_usage),
+        "completion_tokens": sum(msg.completion_tokens for msg in messages if msg.has_usage),
+        "no_product": count_no_product_messages(messages),
+        "cascaded": len(cascaded),
+        "escalated": sum(1 for msg in cascaded if is_escalated(msg)),
+    }
+
+
+def merge_stats(first, second):
+    return {key: first.get(key, 0) + second.get(key, 0) for key in second}
+
+
+class ChatHistoryStore:
+    """
+    Chat history keyed by user id and sharded over SQLite files.
+
+    Each shard runs in WAL mode so sessions read while another one writes, and
+    users on different shards never share a file lock. Messages are appended
+    one row each; the per-row counters let the archive totals be summed in SQL.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS messages (
+        user_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        prompt_tokens INTEGER,
+        completion_tokens INTEGER,
+        no_product INTEGER NOT NULL DEFAULT 0,
+        cascaded INTEGER NOT NULL DEFAULT 0,
+        escalated INTEGER NOT NULL DEFAULT 0,
+        record TEXT NOT NULL,
+        PRIMARY KEY (user_id, seq)
+    );
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    def __init__(self, directory, shards, read_only=False):
+        self.directory = directory
+        self.shards = shards
+        self.read_only = read_only
+        if read_only:
+            # Offline tools only read what the app wrote; never create a store here
+            missing = [path for path in map(self._shard_path, range(shards)) if not os.path.exists(path)]
+            if missing:
+                raise FileNotFoundError(f"Missing chat history shards: {', '.join(missing)}")
+            return
+        os.makedirs(directory, exist_ok=True)
+        for shard in range(shards):
+            with closing(self._connect_shard(shard)) as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(self.SCHEMA)
+
+    def _shard_path(self, shard):
+        return os.path.join(self.directory, f"shard-{shard}.sqlite3")
+
+    def _connect_shard(self, shard):
+        if self.read_only:
+            return sqlite3.connect(f"file:{self._shard_path(shard)}?mode=ro", uri=True, timeout=30)
+        conn = sqlite3.connect(self._shard_path(shard), timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _connect(self, user_id):
+        return self._connect_shard(zlib.crc32(user_id.encode("utf-8")) % self.shards)
+
+    def load(self, user_id, limit):
+        """Return the latest `limit` messages of a user, oldest first."""
+        with closing(self._connect(user_id)) as conn:
+            rows = conn.execute(
+                "SELECT seq, record FROM messages WHERE user_id = ? ORDER BY seq DESC LIMIT ?",
+                (user_id, limit),
+            ).fetchall()
+        messages = []
+        for seq, record in reversed(rows):
+            message = ChatMessage.from_dict(json.loads(record))
+            message.seq = seq
+            messages.append(message)
+        return messages
+
+    def append(self, user_id, messages):
+        """Insert messages that have not been stored yet and assign their seq."""
+        new_messages = [msg for msg in messages if msg.seq is None]
+        if not new_messages:
+            return
+        with closing(self._connect(user_id)) as conn, conn:
+            # Take the write lock before reading MAX(seq) so two tabs of one user get distinct seqs
+            conn.execute("BEGIN IMMEDIATE")
+            (last_seq,) = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM messages WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            for offset, message in enumerate(new_messages, start=1):
+                conn.execute(
+                    "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        user_id,
+                        last_seq + offset,
+                        message.role,
+                        message.prompt_tokens,
+                        message.completion_tokens,
+                        int(message.role == "assistant" and message.product is None),
+                        int(bool(message.cascade)),
+                        int(is_escalated(message)),
+                        json.dumps(message.to_dict()),
+                    ),
+                )
+        for offset, message in enumerate(new_messages, start=1):
+            message.seq = last_seq + offset
+
+    def archive_stats(self, user_id, before_seq=None):
+        """Sidebar counters for the messages of a user stored before `before_seq`."""
+        with closing(self._connect(user_id)) as conn:
+            row = conn.execute(
+                """
+                SELECT COUNT(*), COALESCE(SUM(role = 'user'), 0),
+                       COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0),
+                       COALESCE(SUM(no_product), 0), COALESCE(SUM(cascaded), 0),
+                       COALESCE(SUM(escalated), 0)
+                FROM messages WHERE user_id = ? AND seq < ?
+                """,
+                (user_id, before_seq if before_seq is not None else sys.maxsize),
+            ).fetchone()
+        return dict(zip(summarize_messages([]), row))
+
+    def iter_messages(self):
+        """Yield (user_id, message) for every stored message, streaming one shard at a time."""
+        for shard in range(self.shards):
+            with closing(self._connect_shard(shard)) as conn:
+                rows = conn.execute("SELECT user_id, seq, record FROM messages ORDER BY user_id, seq")
+                for user_id, seq, record in rows:
+                    message = ChatMessage.from_dict(json.loads(record))
+                    message.seq = seq
+                    yield user_id, message
+
+    def has_messages(self, user_id):
+        with closing(self._connect(user_id)) as conn:
+            return conn.execute("SELECT 1 FROM messages WHERE user_id = ? LIMIT 1", (user_id,)).fetchone() is not None
+
+    def clear(self, user_id):
+        with closing(self._connect(user_id)) as conn, conn:
+            conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+
+    def import_legacy(self, path, user_id):
+        """Copy the old single-file shelve history into the store once."""
+        with closing(self._connect(user_id)) as conn:
+            # A failed attempt is recorded too, so a file this platform can't read isn't retried every start
+            if conn.execute(
+                "SELECT 1 FROM meta WHERE key IN ('legacy_imported', 'legacy_import_failed')"
+            ).fetchone():
+                return
+        import shelve
+
+        try:
+            with shelve.open(path, flag="r") as db:
+                records = []
+                for chunk in range(db.get("archive_count", 0)):
+                    records.extend(db.get(f"archive:{chunk}", []))
+                records.extend(db.get("messages", []))
+        except Exception as error:
+            # Berkeley DB files written on macOS cannot be opened by most Linux Python builds
+            logger.warning("Chat history in %r could not be imported on this platform: %s", path, error)
+            with closing(self._connect(user_id)) as conn, conn:
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('legacy_import_failed', ?)", (str(error),))
+            return
+        self.append(user_id, [ChatMessage.from_dict(record) for record in records])
+        with closing(self._connect(user_id)) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('legacy_imported', '1')")
+
+    def legacy_import_failed(self, user_id):
+        with closing(self._connect(user_id)) as conn:
+            return conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_import_failed'").fetchone() is not None
+
+
+@st.cache_resource
+def get_history_store():
+    # One store per process, shared by every session
+    store = ChatHistoryStore(CHAT_HISTORY_DIR, CHAT_HISTORY_SHARDS)
+    if any(os.path.exists(LEGACY_HISTORY_FILE + ext) for ext in ("", ".db", ".dat")):
+        store.import_legacy(LEGACY_HISTORY_FILE, LEGACY_USER_ID)
+    return store
+
+
+def get_user_id():
+    """Stable id of the browser user, kept in the ?user= query parameter across reloads."""
+    if "user_id" not in st.session_state:
+        user_id = st.query_params.get("user")
+        if not user_id:
+            user_id = uuid.uuid4().hex
+            st.query_params["user"] = user_id
+        st.session_state.user_id = user_id
+    return st.session_state.user_id
+
+
+# Function to load chat history of a user
+def turn_start(messages, index):
+    """Index of the first user question at or after `index`, so a kept window never opens on an answer."""
+    for position in range(index, len(messages)):
+        if messages[position].role == "user":
+            return position
+    # No question after the cut: keep the last whole turn instead of nothing
+    for position in range(min(index, len(messages)) - 1, -1, -1):
+        if messages[position].role == "user":
+            return position
+    return index
+
+
+def load_chat_history(user_id, limit=MAX_MESSAGES_IN_MEMORY):
+    messages = get_history_store().load(user_id, limit)
+    return messages[turn_start(messages, 0):]
+
+
+def load_archive_stats(user_id, messages):
+    before_seq = messages[0].seq if messages else None
+    return get_history_store().archive_stats(user_id, before_seq)
+
+
+# Function to save chat history of a user
+def save_chat_history(user_id, messages, limit=MAX_MESSAGES_IN_MEMORY):
+    """
+    Store the new messages of a session and drop the oldest turns from memory
+    once more than `limit` messages are held.
+
+    Returns:
+        tuple: (messages to keep in memory, stats of the messages left out).
+    """
+    get_history_store().append(user_id, messages)
+    if len(messages) > limit:
+        # Trim down to about half the limit so this happens in batches, at a question
+        messages = messages[turn_start(messages, len(messages) - limit // 2):]
+    return messages, load_archive_stats(user_id, messages)
+
+
+def clear_chat_history(user_id):
+    get_history_store().clear(user_id)
+
+
+def deep_getsizeof(obj, seen=None):
+    """Approximate memory held by an object and everything it references."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_getsizeof(k, seen) + deep_getsizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_getsizeof(item, seen) for item in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_getsizeof(getattr(obj, name, None), seen) for name in obj.__slots__)
+    elif hasattr(obj, "__dict__"):
+        size += deep_getsizeof(obj.__dict__, seen)
+    return size
 
 
 def extract_query_parameters(content):
     url_pattern = r'https?://[^\s]+'
     match = re.search(url_pattern, content)
     if match:
-        full_url = match.group(0)
+        # Drop sentence punctuation the model put right after the URL
+        full_url = match.group(0).rstrip(".,;)")
         # Parse the URL to get query parameters
         parsed_url = urlparse(full_url)
         relative_url = f"{parsed_url.path}?{parsed_url.query}" if parsed_url.query else parsed_url.path
@@ -140,6 +788,63 @@ def extract_relative_url(content):
         return relative_url
     return None
 
+# Products shown per answer and the extra ones fetched to rank from
+PRODUCTS_SHOWN = 4
+PRODUCT_FETCH_BUFFER = int(os.getenv("PRODUCT_FETCH_BUFFER", "2"))
+# Comma-separated ranking criteria applied in order: position, offers, new-arrival
+PRODUCT_RANKING = os.getenv("PRODUCT_RANKING", "position")
+# When set, "position" ranks by a shuffle seeded with this value and the query URL
+PRODUCT_DIVERSITY_SEED = os.getenv("PRODUCT_DIVERSITY_SEED")
+
+
+def product_rank_key(criteria):
+    """Build a sort key over (position, item) pairs; lower values rank first."""
+    for criterion in criteria:
+        if criterion not in ("position", "offers", "new-arrival"):
+            raise ValueError(f"Unknown product ranking criterion: {criterion}")
+
+    def key(entry):
+        position, item = entry
+        offers = [offer for offer in item.get("offer_data") or [] if isinstance(offer, dict)]
+        labels = " ".join(offer.get("label") or "" for offer in offers).lower()
+        values = []
+        for criterion in criteria:
+            if criterion == "position":
+                values.append(position)
+            elif criterion == "offers":
+                values.append(0 if offers else 1)
+            else:
+                values.append(0 if "new" in labels else 1)
+        return values
+
+    return key
+
+
+def select_products(items, url_key, limit=PRODUCTS_SHOWN, ranking=PRODUCT_RANKING, seed=PRODUCT_DIVERSITY_SEED):
+    """
+    Pick the products to show for a query, deterministically.
+
+    Args:
+        items (list): Product items in API order.
+        url_key (str): Query URL, mixed into the diversity seed.
+        limit (int): Number of products to return.
+        ranking (str): Comma-separated ranking criteria.
+        seed (str, optional): Diversity seed. Without it "position" is the API
+            order; with it "position" is a shuffle of the fetched items seeded
+            with `seed` and the query URL, so the other criteria still rank first.
+
+    Returns:
+        list: Up to `limit` items; identical queries give identical results.
+    """
+    items = list(items or [])
+    if seed is not None:
+        random.Random(f"{seed}:{canonical_url(url_key)}").shuffle(items)
+    candidates = list(enumerate(items))
+    criteria = [criterion.strip() for criterion in ranking.split(",") if criterion.strip()]
+    candidates.sort(key=product_rank_key(criteria))
+    return [item for _, item in candidates[:limit]]
+
+
 def card(product_details):
     if product_details is None:
         st.markdown("No releated images found")
@@ -227,7 +932,8 @@ def card(product_details):
                             unsafe_allow_html=True
                         )
 
-def findCategoryFromContentByGpt(query):
+@st.cache_data(max_entries=1000, show_spinner=False)
+def findCategoryFromContentByGpt(query, model=None):
     last_prompt =[]
     last_prompt.append({"role":"system","content":"""
     i want to know the category from the query 
@@ -239,10 +945,7 @@ category: bra,panty
     })
 
     last_prompt.append({"role":"user","content":query})
-    response = client.chat.completions.create(
-            model=st.session_state["openai_model"],
-            messages=last_prompt
-        )
+    response = create_chat_completion(last_prompt, model=model)
     value= response.choices[0].message.content
     category = findCategoryFromContent(value)
     return category
@@ -272,70 +975,48 @@ def findCategoryFromContent(content):
     return matched_categories
 
 def count_no_product_messages(messages):
-    return sum(1 for message in messages if message.get("product") is None and message.get("role") == "assistant")
+    return sum(1 for message in messages if message.product is None and message.role == "assistant")
 
 def display_chat_messages():
+    archived = st.session_state.archive_stats["messages"]
     for i, message in enumerate(st.session_state.messages):
         # Skip the first user message, if necessary
-        if i != 0:
-            avatar = USER_AVATAR if message["role"] == "user" else BOT_AVATAR
-            with st.chat_message(message["role"], avatar=avatar):
+        if i != 0 or archived:
+            avatar = USER_AVATAR if message.role == "user" else BOT_AVATAR
+            with st.chat_message(message.role, avatar=avatar):
                 # Display text content if it exists
-                if "content" in message and message["content"]:
-                    if "Qno" in message and message["Qno"]:
-                         st.markdown(f"**Qno {message['Qno']}:** {message['content']}")
+                if message.content:
+                    if message.qno:
+                         st.markdown(f"**Qno {message.qno}:** {message.content}")
                     else:
-                        st.markdown(message["content"])
-                        if "product" in message and message["product"] is None:
+                        st.markdown(message.content)
+                        if message.role == "assistant" and message.product is None:
                              st.image(image="https://www.shyaway.com/media/wysiwyg/Sorry-no-results-found-350-x-350.jpg",width=360)
                              st.markdown("No image found")
 
-                if "usage" in message and message["usage"]:
-                    usage = message["usage"]
+                if message.has_usage:
                     product_count = 0
-                    if "product" in message and message["product"] is None:
+                    if message.product is None:
                         product_count = 0
                     else:
-                        product_count = len(message['product'])
+                        product_count = len(message.product)
                     st.markdown(
                         f"""
-                        **Prompt**:&nbsp;&nbsp;{usage.prompt_tokens} &nbsp;&nbsp;&nbsp;&nbsp;**Answer**:&nbsp;&nbsp;{usage.completion_tokens} &nbsp;&nbsp;&nbsp;&nbsp;**Total**:&nbsp;&nbsp;{usage.total_tokens}
+                        **Prompt**:&nbsp;&nbsp;{message.prompt_tokens} &nbsp;&nbsp;&nbsp;&nbsp;**Answer**:&nbsp;&nbsp;{message.completion_tokens} &nbsp;&nbsp;&nbsp;&nbsp;**Total**:&nbsp;&nbsp;{message.total_tokens}
                         &nbsp;&nbsp;&nbsp;&nbsp;**Img Count**:&nbsp;&nbsp;{product_count}""",
                         unsafe_allow_html=True
                     )
+                if message.cascade:
+                    display_cascade_trace(message.cascade)
                 # Display the image if image_url exists
-                if "product" in message and message["product"]:
-                    product_details = message['product']
+                if message.product:
+                    product_details = message.product
                     card(product_details=product_details)
 
 
 
 
-# Function to handle chat interaction
-def handle_chat_interaction(prompt):
-    user_messages = [msg for msg in st.session_state.messages if msg.get("role") == "user"]
-    user_messages_count = len(user_messages)
-
-    if(st.session_state.selected_tab !="All"):
-        category = st.session_state.selected_tab
-    else:
-        category = findCategoryFromContent(prompt)
-        if category:
-            category = list(category)[0]
-            # print(category)
-        else:
-            category = findCategoryFromContentByGpt(prompt)
-            category = list(category)[0]
-            print(category)
-
-    
-    st.session_state.messages.append({"role": "user","Qno":user_messages_count, "content": prompt,"category":category})
-    
-    with st.chat_message("user", avatar=USER_AVATAR):
-        st.markdown(f"**Qno {user_messages_count+1}:** {prompt}")
-
-    last_prompt = []
-    category_prompts = {
+CATEGORY_PROMPTS = {
     "Bra": """
    i want answers related to shyaway.com alone
    category : Bra
@@ -372,7 +1053,7 @@ price=0-300,1200-1500,1500-1800,300-600,600-900,900-1200
    price=0-300,1200-1500,1500-1800,300-600,600-900,900-1200
    Convert the query into attributes for the Panty category. Match synonyms or contextual words with the listed panty attributes and provide the result in the following format:
    category: panty, url: https://www.shyaway.com/panty-online/?{attribute=value}
-   Example : category: panty, url: https://www.shyaway.com/panty-online/?fabric=cotton&size=XL  
+   Example : category: panty, url: https://www.shyaway.com/panty-online/?fabric=cotton-spandex&size=XL  
     """,
     "lingerie-set":"""
     i want  answers related to shyaway.com alone
@@ -399,7 +1080,7 @@ price=0-300,1200-1500,1500-1800,300-600,600-900,900-1200
    price=0-300,1200-1500,1500-1800,300-600,600-900,900-1200
    Convert the query into attributes for the Lingerie Set category. Match synonyms or contextual words with the listed lingerie set attributes and provide the result in the following format:
    category: lingerie-set, url: https://www.shyaway.com/lingerie-set-online/?{attribute=value}
-   Example: category: lingerie-set, url: https://www.shyaway.com/lingerie-set-online/?lingerieset-bra-seam=seamless&color-family=skin&size=m  
+   Example: category: lingerie-set, url: https://www.shyaway.com/lingerie-set-online/?lingerieset-bra-seam=seamless&color-family=skin&size=38D/XL  
     """,
     "sportswear": """
     category : sportswear
@@ -442,7 +1123,7 @@ price=0-300,1200-1500,1500-1800,300-600,600-900,900-1200
    price=0-300,1200-1500,1500-1800,300-600,600-900,900-1200
    Convert the query into attributes for the Shapewear category. Match synonyms or contextual words with the listed shapewear attributes and provide the result in the following format:
    category: shapewear, url: https://www.shyaway.com/shapewear-online/?{attribute=value}
-   Examples :category: shapewear, url: https://www.shyaway.com/shapewear-online/?shapewear-feature=tummy-tucker&color-family=black  
+   Examples :category: shapewear, url: https://www.shyaway.com/shapewear-online/?shapewear-type=tummy-tucker&color-family=black  
     """,
     "accessories":"""
     category : accessories
@@ -577,46 +1258,254 @@ Example : category: bra, url: https://www.shyaway.com/bra-online/?color-family=r
 """
 
 }
-    common = """
+COMMON_PROMPT = """
     If no direct match is found, infer the closest matching attribute based on context.
     List multiple matching attribute values as comma-separated.dont divaite from i gave the prompt should provide requested attribute and value if the user ask size you should provide. 
     should provide justify your suggestion
+"""
+
+
+# Model used for the cheap first pass of the cascade; the session model is the full tier.
+# Even when both are the same model the cheap tier saves tokens with its tight prompt.
+CASCADE_MODEL = os.getenv("OPENAI_CASCADE_MODEL", "gpt-4o-mini-2024-07-18")
+
+
+def normalize_attribute_value(value):
+    return value.strip().lower().replace(" ", "-")
+
+
+def parse_category_vocabulary(category_prompt):
+    """
+    Collect the allowed `attribute=value,value` pairs listed in a category prompt.
+
+    Returns:
+        dict: Attribute name mapped to the set of normalized values.
+    """
+    vocabulary = {}
+    for line in category_prompt.splitlines():
+        match = re.match(r"\s*([\w-]+)=(.+)$", line)
+        if match:
+            values = match.group(2).split(",")
+            vocabulary[match.group(1).lower()] = {normalize_attribute_value(v) for v in values if v.strip()}
+    return vocabulary
+
+
+CATEGORY_VOCABULARY = {
+    name.lower(): parse_category_vocabulary(category_prompt)
+    for name, category_prompt in CATEGORY_PROMPTS.items()
+    if name != "All"
+}
+
+
+def tight_category_prompt(category):
+    """
+    Short prompt for the cheap tier: the category's `attribute=values` lines
+    and the expected answer format, without the prose of the full prompt.
+    """
+    attribute_lines = [
+        line.strip()
+        for line in CATEGORY_PROMPTS[category].splitlines()
+        if re.match(r"\s*([\w-]+)=(.+)$", line)
+    ]
+    slug = category.lower()
+    return "\n".join([
+        f"shyaway.com {slug} filters (attribute=values):",
+        *attribute_lines,
+        "Map the query to these values only. Reply with one line and nothing else:",
+        f"category: {slug}, url: https://www.shyaway.com/{slug}-online/?attribute=value,value&attribute=value",
+    ])
+
+
+TIGHT_PROMPTS = {
+    name: tight_category_prompt(name)
+    for name in CATEGORY_PROMPTS
+    if name != "All"
+}
+
+
+def is_valid_url_key(url_key):
     """
-    # Get the specific hello_prompt based on the selected_tab
-    hello_prompt = f"{category_prompts.get(category, "")}{common}"
+    Check that a generated URL points at a known category listing and only uses
+    attribute values from that category's vocabulary.
+    """
+    if not url_key:
+        return False
+    parsed_url = urlparse(url_key)
+    match = re.match(r"/?([\w-]+)-online/?$", parsed_url.path)
+    if not match:
+        return False
+    vocabulary = CATEGORY_VOCABULARY.get(match.group(1).lower())
+    if vocabulary is None:
+        return False
+    for attribute, values in parse_qs(parsed_url.query).items():
+        allowed = vocabulary.get(attribute.lower())
+        if allowed is None:
+            return False
+        for value in ",".join(values).split(","):
+            if normalize_attribute_value(value) not in allowed:
+                return False
+    return True
+
+
+def canonical_url(url_key):
+    """
+    Normalize a relative listing URL so equivalent answers compare equal:
+    lowercase path, sorted attributes and sorted, normalized values.
+    """
+    if not url_key:
+        return None
+    parsed_url = urlparse(url_key)
+    path = parsed_url.path.strip("/").lower()
+    params = []
+    for attribute, values in sorted(parse_qs(parsed_url.query).items()):
+        normalized = sorted({normalize_attribute_value(v) for v in ",".join(values).split(",") if v.strip()})
+        params.append(f"{attribute.lower()}={','.join(normalized)}")
+    return f"{path}/?{'&'.join(params)}" if params else f"{path}/"
+
+
+# Token usage of a question, added up over the cascade tiers that ran
+TokenUsage = namedtuple("TokenUsage", ["prompt_tokens", "completion_tokens", "total_tokens"])
+
+
+def record_tier(trace, tier, start, passed, tokens=0):
+    trace.append({
+        "tier": tier,
+        "latency": round(time.perf_counter() - start, 3),
+        "passed": passed,
+        "tokens": tokens,
+    })
+
+
+def detect_category(prompt, trace, full_model=None):
+    """
+    Find the category of a question, trying keyword rules first, then the
+    cheap model and only then the full model (the session model by default).
+
+    Returns:
+        str: Category name, or "All" when no tier could find one.
+    """
+    start = time.perf_counter()
+    categories = findCategoryFromContent(prompt)
+    record_tier(trace, "rules", start, bool(categories))
+    if categories:
+        return sorted(categories)[0]
+
+    if full_model is None:
+        full_model = st.session_state["openai_model"]
+    tiers = [("cheap", CASCADE_MODEL)]
+    if full_model != CASCADE_MODEL:
+        tiers.append(("full", full_model))
+    for tier, model in tiers:
+        start = time.perf_counter()
+        categories = findCategoryFromContentByGpt(prompt, model=model)
+        record_tier(trace, tier, start, bool(categories))
+        if categories:
+            return sorted(categories)[0]
+    return "All"
+
+
+def generate_url_answer(prompt, category, trace, full_model=None):
+    """
+    Ask for the product URL with the tight category prompt on the cheap model,
+    escalating to the full prompt and session model when the URL does not validate.
+    The tight tier also runs when both tiers use the same model, since the
+    shorter prompt and one-line answer are where the saving comes from.
+
+    Returns:
+        tuple: (response, response text, relative URL or None) of the last tier run,
+            and the TokenUsage summed over every tier that ran.
+    """
+    if full_model is None:
+        full_model = st.session_state["openai_model"]
+    tiers = []
+    if category in TIGHT_PROMPTS:
+        tiers.append(("cheap", CASCADE_MODEL, TIGHT_PROMPTS[category]))
+    tiers.append(("full", full_model, f"{CATEGORY_PROMPTS.get(category, '')}{COMMON_PROMPT}"))
+
+    prompt_tokens = completion_tokens = 0
+    for tier, model, system_prompt in tiers:
+        start = time.perf_counter()
+        last_prompt = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt},
+        ]
+        response = create_chat_completion(last_prompt, model=model)
+        full_response = response.choices[0].message.content
+        # Process the URL key
+        url_key = extract_relative_url(full_response)
+        if url_key is None:
+            url_key = extract_query_parameters(full_response)
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            prompt_tokens += usage.prompt_tokens
+            completion_tokens += usage.completion_tokens
+        passed = is_valid_url_key(url_key)
+        record_tier(trace, tier, start, passed, usage.total_tokens if usage else 0)
+        if passed:
+            break
+    usage = TokenUsage(prompt_tokens, completion_tokens, prompt_tokens + completion_tokens)
+    return response, full_response, url_key, usage
+
+
+def is_escalated(message):
+    # Escalated when a full tier ran after a failed cheap tier
+    for trace in (message.cascade or {}).values():
+        cheap_failed = False
+        for entry in trace:
+            if entry["tier"] == "cheap" and not entry["passed"]:
+                cheap_failed = True
+            elif entry["tier"] == "full" and cheap_failed:
+                return True
+    return False
+
+
+def display_cascade_trace(cascade):
+    steps = [
+        f"{step}: {entry['tier']} {entry['latency']}s {'✓' if entry['passed'] else '✗'}"
+        for step, trace in cascade.items()
+        for entry in trace
+    ]
+    if steps:
+        st.caption(" &nbsp;→&nbsp; ".join(steps))
+
+
+# Function to handle chat interaction
+def handle_chat_interaction(prompt):
+    user_messages = [msg for msg in st.session_state.messages if msg.role == "user"]
+    user_messages_count = st.session_state.archive_stats["questions"] + len(user_messages)
+
+    # Per-tier trace of the model cascade, stored with the answer
+    cascade = {"category": [], "url": []}
+
+    if(st.session_state.selected_tab !="All"):
+        category = st.session_state.selected_tab
+    else:
+        category = detect_category(prompt, cascade["category"])
+
+    
+    st.session_state.messages.append(ChatMessage("user", prompt, qno=user_messages_count, category=category))
     
-    last_prompt.append({"role":"system","content":hello_prompt})
-    last_prompt.append({"role": "user", "content": prompt})
+    with st.chat_message("user", avatar=USER_AVATAR):
+        st.markdown(f"**Qno {user_messages_count+1}:** {prompt}")
 
     with st.chat_message("assistant", avatar=BOT_AVATAR):
         message_placeholder = st.empty()
         token_place_holder = st.empty
         
-        # Making a non-streaming request
-        response = client.chat.completions.create(
-            model=st.session_state["openai_model"],
-            messages=last_prompt
-        )
-
-        # Access the token usage directly from the response's attribute
-        if hasattr(response, 'usage'):
-            usage_info = response.usage
+        # Making a non-streaming request, escalating to the full model if needed
+        response, full_response, url_key, usage_info = generate_url_answer(prompt, category, cascade["url"])
     
-        full_response = response.choices[0].message.content        
         message_placeholder.markdown(full_response)
-        # Process the URL key
-        url_key = extract_relative_url(full_response)
-        if url_key is None:
-            url_key = extract_query_parameters(full_response)
 	    
         product_details = None  # Default value
         if url_key is not None:
-            result = get_product_list(url_key, page=1, limit=20)
+            # Only fetch what will be shown plus a small buffer to rank from
+            result = get_product_list(url_key, page=1, limit=PRODUCTS_SHOWN + PRODUCT_FETCH_BUFFER)
             data = result
             
             if "data" in data and "getProductList" in data["data"]:
                 items = data["data"]["getProductList"]["data"]["items"]
-                random_items = random.sample(items, min(len(items), 20))  # Randomly select up to 4 items
+                selected_items = select_products(items, url_key)
                 product_details = [
                     {
                         'product_link': item['product_link'],
@@ -624,7 +1513,7 @@ Example : category: bra, url: https://www.shyaway.com/bra-online/?color-family=r
                         'image_url': item['image']['url'],
                         'offer': item.get('offer_data', {})
                     }
-                    for item in random_items
+                    for item in selected_items
                 ]
                 st.markdown(
                     f"""
@@ -647,28 +1536,40 @@ Example : category: bra, url: https://www.shyaway.com/bra-online/?color-family=r
         unsafe_allow_html=True
     )
         
-        st.session_state.messages.append({
-            "role": "assistant",
-            "content": full_response,
-            "product": product_details,
-            "usage":usage_info,
-            "category":st.session_state.selected_tab
-        })
-
-    save_chat_history(st.session_state.messages)
+        display_cascade_trace(cascade)
+
+        st.session_state.messages.append(ChatMessage(
+            "assistant",
+            full_response,
+            product=product_details,
+            usage=usage_info,
+            category=st.session_state.selected_tab,
+            cascade=cascade
+        ))
+
+    st.session_state.messages, st.session_state.archive_stats = save_chat_history(
+        st.session_state.user_id, st.session_state.messages
+    )
 
 
 def display_total_question_count(placeholder):
-    user_messages = [msg for msg in st.session_state.messages if msg.get("role") == "user"]
-    total_questions = len(user_messages)+1
+    # Totals cover the messages in memory plus the archived ones
+    stats = merge_stats(st.session_state.archive_stats, summarize_messages(st.session_state.messages))
+    total_questions = stats["questions"]+1
     
     # Calculate total tokens used by the user prompts and assistant responses
-    total_prompt_tokens = sum(msg["usage"].prompt_tokens for msg in st.session_state.messages if "usage" in msg)
-    total_answer_tokens = sum(msg["usage"].completion_tokens for msg in st.session_state.messages if "usage" in msg)
+    total_prompt_tokens = stats["prompt_tokens"]
+    total_answer_tokens = stats["completion_tokens"]
     
     total_tokens = total_prompt_tokens + total_answer_tokens
 
-    no_product_count = count_no_product_messages(st.session_state.messages)
+    no_product_count = stats["no_product"]
+
+    escalated_count = stats["escalated"]
+    escalation_rate = 100 * escalated_count / stats["cascaded"] if stats["cascaded"] else 0
+
+    session_memory_kb = deep_getsizeof(st.session_state.messages) / 1024
+    archived_count = stats["messages"] - len(st.session_state.messages)
     
     # Display the information
     placeholder.markdown(f"""
@@ -682,6 +1583,10 @@ def display_total_question_count(placeholder):
 
     **Total No Record Count**: {no_product_count}
 
+    **Escalated to Full Tier**: {escalated_count} ({escalation_rate:.0f}%)
+
+    **Session Memory**: {session_memory_kb:.1f} KB ({len(st.session_state.messages)} in memory, {archived_count} archived)
+
     """)
 
 
@@ -697,22 +1602,95 @@ def getBulkQuestion(content):
                 current_question = ""
     return questions
 
+# Third-party Dialogflow messenger shown as a floating chat bubble
+DF_MESSENGER_HTML = """
+        <link rel="stylesheet" href="https://www.gstatic.com/dialogflow-console/fast/df-messenger/prod/v1/themes/df-messenger-default.css">
+        <script src="https://www.gstatic.com/dialogflow-console/fast/df-messenger/prod/v1/df-messenger.js"></script>
+        <df-messenger
+            project-id="circletosearch"
+            agent-id="5861dbf5-33bb-4169-a7d9-e5c0059144f2"
+            language-code="en"
+            max-query-length="-1">
+          <df-messenger-chat-bubble
+           chat-title="shyley-agent-1">
+          </df-messenger-chat-bubble>
+        </df-messenger>
+        <style>
+          df-messenger {
+            z-index: 999;
+            position: fixed;
+            --df-messenger-font-color: #000;
+            --df-messenger-font-family: Google Sans;
+            --df-messenger-chat-background: #f3f6fc;
+            --df-messenger-message-user-background: #d3e3fd;
+            --df-messenger-message-bot-background: #fff;
+            bottom: 16px;
+            right: 16px;
+          }
+        </style>
+    """
+
+
+def display_df_messenger():
+    import streamlit.components.v1 as components
+    components.html(DF_MESSENGER_HTML, height=800)
+
+
+def ensure_history_loaded(user_id):
+    # Stored history is read once per session, the first time it is displayed
+    if not st.session_state.history_loaded:
+        st.session_state.messages = load_chat_history(user_id)
+        st.session_state.archive_stats = load_archive_stats(user_id, st.session_state.messages)
+        st.session_state.history_loaded = True
+
+
+def display_rerun_profile():
+    RERUN_PROFILE["total"] = time.perf_counter() - SCRIPT_START
+    with st.sidebar.expander("Startup profile"):
+        st.markdown("  \n".join(
+            f"**{name}**: {seconds * 1000:.1f} ms" for name, seconds in RERUN_PROFILE.items()
+        ))
+
+
 def main():
+    RERUN_PROFILE["imports and setup"] = time.perf_counter() - SCRIPT_START
+
     # Create placeholders for the title and question count
     title_placeholder = st.empty()
     title_placeholder.title("Shyley")
 
-    # Load chat history
-    data = load_chat_history()
-    if "messages" not in st.session_state:
-        st.session_state.messages = data
+    # Load chat history of this user
+    with profile_step("history"):
+        user_id = get_user_id()
+        if "messages" not in st.session_state:
+            st.session_state.history_loaded = False
+            if LAZY_INIT:
+                # Only the sidebar totals are needed until the history is shown
+                st.session_state.messages = []
+                st.session_state.archive_stats = load_archive_stats(user_id, [])
+            else:
+                ensure_history_loaded(user_id)
 
+    sidebar_start = time.perf_counter()
     # Sidebar with options
     with st.sidebar:
         # Add a unique key to the button
         if st.button("Delete Chat History", key="delete_chat_history_button"):
+            # Clear the stored history first and read the totals back, so they can't reappear
+            clear_chat_history(user_id)
             st.session_state.messages = []
-            # save_chat_history([])
+            st.session_state.archive_stats = load_archive_stats(user_id, [])
+            st.session_state.history_loaded = True
+
+        # History from before per-user storage is kept under its own user id
+        if "legacy_available" not in st.session_state:
+            st.session_state.legacy_available = (
+                user_id != LEGACY_USER_ID and get_history_store().has_messages(LEGACY_USER_ID)
+            )
+        if st.session_state.legacy_available:
+            st.caption(f"Older shared chat history: [open it](?user={LEGACY_USER_ID})")
+        elif user_id == LEGACY_USER_ID and get_history_store().legacy_import_failed(LEGACY_USER_ID):
+            st.warning("The older chat history could not be imported on this server; the log has the details.")
 
         # Placeholder for question count
         question_count_placeholder = st.empty()
@@ -748,8 +1726,10 @@ def main():
 
         st.divider()
 
+        show_history = st.toggle("Show chat history", value=not LAZY_INIT, key="sidebar_show_history")
+        show_widget = st.toggle("Dialogflow assistant", value=not LAZY_INIT, key="sidebar_show_widget")
 
-
+        st.divider()
 
         # Update session state only if the selected tab changes
         if qa_state != st.session_state.qa_state:
@@ -787,9 +1767,15 @@ def main():
             st.subheader("Explore ALl Section")
             st.write("Explore the latest in All lingeries here!")
 
+    RERUN_PROFILE["sidebar"] = time.perf_counter() - sidebar_start
+
     # Display all chat messages
-    display_chat_messages()
+    with profile_step("messages"):
+        if show_history:
+            ensure_history_loaded(user_id)
+            display_chat_messages()
 
+    RERUN_PROFILE["time to first input"] = time.perf_counter() - SCRIPT_START
     # Main chat input
     if prompt := st.chat_input("How can I help?"):
         if st.session_state.qa_state == "single":
@@ -798,33 +1784,13 @@ def main():
             questions=getBulkQuestion(prompt)
             for q in questions:
                 handle_chat_interaction(q)
+        RERUN_PROFILE["answer"] = time.perf_counter() - SCRIPT_START - RERUN_PROFILE["time to first input"]
 
-    components.html("""
-        <link rel="stylesheet" href="https://www.gstatic.com/dialogflow-console/fast/df-messenger/prod/v1/themes/df-messenger-default.css">
-        <script src="https://www.gstatic.com/dialogflow-console/fast/df-messenger/prod/v1/df-messenger.js"></script>
-        <df-messenger
-            project-id="circletosearch"
-            agent-id="5861dbf5-33bb-4169-a7d9-e5c0059144f2"
-            language-code="en"
-            max-query-length="-1">
-          <df-messenger-chat-bubble
-           chat-title="shyley-agent-1">
-          </df-messenger-chat-bubble>
-        </df-messenger>
-        <style>
-          df-messenger {
-            z-index: 999;
-            position: fixed;
-            --df-messenger-font-color: #000;
-            --df-messenger-font-family: Google Sans;
-            --df-messenger-chat-background: #f3f6fc;
-            --df-messenger-message-user-background: #d3e3fd;
-            --df-messenger-message-bot-background: #fff;
-            bottom: 16px;
-            right: 16px;
-          }
-        </style>
-    """, height=800)
+    with profile_step("widget"):
+        if show_widget:
+            display_df_messenger()
+
+    display_rerun_profile()
 
 
 
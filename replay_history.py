@@ -0,0 +1,200 @@
+"""
+Replay stored chat history through the category/URL pipeline.
+
+Streams the question/answer pairs from the history store (or the old
+single-file shelve history), re-runs each question and reports, per
+category, how often the category and canonical URL drift from what was
+stored, the no-product rate and the replay latency. In rules mode, questions
+the keyword rules cannot classify are reported as "rules miss" and left out
+of the category drift, and the latency columns show what the stored cascade
+took (or "-" where no trace was kept). The store is opened read-only.
+
+    python replay_history.py                      # rules only, no API calls
+    python replay_history.py --mode live --limit 200
+    python replay_history.py --legacy chat_history --json
+"""
+import argparse
+import dbm
+import json
+import math
+import os
+import shelve
+import statistics
+import time
+from collections import defaultdict
+
+# Rules mode makes no API calls, so only create the OpenAI client if the cascade runs
+os.environ.setdefault("LAZY_INIT", "true")
+
+import chat
+
+
+def iter_store_messages(directory, shards):
+    if not os.path.isdir(directory):
+        raise SystemExit(f"No chat history directory found at {directory!r}.")
+    try:
+        store = chat.ChatHistoryStore(directory, shards, read_only=True)
+    except FileNotFoundError as error:
+        raise SystemExit(f"{error}. Check --history-dir and --shards.")
+    return store.iter_messages()
+
+
+def iter_legacy_messages(path):
+    if not any(os.path.exists(path + ext) for ext in ("", ".db", ".dat")):
+        raise SystemExit(f"No chat history file found at {path!r}.")
+    try:
+        db = shelve.open(path, flag="r")
+    except dbm.error as error:
+        raise SystemExit(
+            f"{path!r} is not readable on this platform ({error}). "
+            "The old history is a Berkeley DB written on macOS; run the replay there."
+        )
+    # The shelve file is read one key at a time; each key still unpickles whole
+    with db:
+        for chunk in range(db.get("archive_count", 0)):
+            for record in db.get(f"archive:{chunk}", []):
+                yield chat.LEGACY_USER_ID, chat.ChatMessage.from_dict(record)
+        for record in db.get("messages", []):
+            yield chat.LEGACY_USER_ID, chat.ChatMessage.from_dict(record)
+
+
+def iter_question_answers(messages):
+    """Pair every user question with the assistant answer that follows it."""
+    questions = {}
+    for user_id, message in messages:
+        if message.role == "user":
+            questions[user_id] = message
+        elif message.role == "assistant" and user_id in questions:
+            yield questions.pop(user_id), message
+
+
+def stored_url(answer):
+    url_key = chat.extract_relative_url(answer.content or "")
+    if url_key is None:
+        url_key = chat.extract_query_parameters(answer.content or "")
+    return chat.canonical_url(url_key)
+
+
+def stored_latency(answer):
+    """Seconds the stored cascade took for this answer, or None if it kept no trace."""
+    if not answer.cascade:
+        return None
+    return sum(entry["latency"] for entry in answer.cascade)
+
+
+def replay_question(question, answer, mode, model):
+    """
+    Run one stored question again.
+
+    Returns:
+        tuple: (category, canonical URL or None in rules mode, seconds taken).
+            The category is None when the keyword rules find nothing in rules mode.
+    """
+    start = time.perf_counter()
+    # A category picked in the sidebar was forced, not detected
+    if answer.category and answer.category != "All":
+        category = answer.category
+    elif mode == "rules":
+        categories = chat.findCategoryFromContent(question.content)
+        category = sorted(categories)[0] if categories else None
+    else:
+        category = chat.detect_category(question.content, [], full_model=model)
+
+    url = None
+    if mode == "live":
+        _, _, url_key, _ = chat.generate_url_answer(question.content, category, [], full_model=model)
+        url = chat.canonical_url(url_key)
+    return category, url, time.perf_counter() - start
+
+
+def analyze(pairs, mode, model, limit=None):
+    stats = defaultdict(lambda: {
+        "questions": 0,
+        "category_drift": 0,
+        "rules_miss": 0,
+        "url_drift": 0,
+        "no_product": 0,
+        "latencies": [],
+    })
+    for count, (question, answer) in enumerate(pairs):
+        if limit is not None and count >= limit:
+            break
+        category, url, elapsed = replay_question(question, answer, mode, model)
+        entry = stats[question.category or "All"]
+        entry["questions"] += 1
+        if category is None:
+            # The stored run needed a model here; that is rules coverage, not drift
+            entry["rules_miss"] += 1
+        else:
+            entry["category_drift"] += int(category != (question.category or "All"))
+        if mode == "live":
+            entry["url_drift"] += int(url != stored_url(answer))
+        entry["no_product"] += chat.count_no_product_messages([answer])
+        if mode == "rules":
+            # Timing one regex says nothing; show what the stored run took instead
+            elapsed = stored_latency(answer)
+        if elapsed is not None:
+            entry["latencies"].append(elapsed)
+
+    report = {}
+    for category, entry in sorted(stats.items()):
+        questions = entry["questions"]
+        compared = questions - entry["rules_miss"]
+        latencies = sorted(entry["latencies"])
+        report[category] = {
+            "questions": questions,
+            "category_drift": entry["category_drift"] / compared if compared else None,
+            "rules_miss": entry["rules_miss"] / questions if mode == "rules" else None,
+            "url_drift": entry["url_drift"] / questions if mode == "live" else None,
+            "no_product": entry["no_product"] / questions,
+            "latency_mean_ms": statistics.fmean(latencies) * 1000 if latencies else None,
+            "latency_p95_ms": latencies[math.ceil(0.95 * len(latencies)) - 1] * 1000 if latencies else None,
+        }
+    return report
+
+
+def print_report(report):
+    header = f"{'category':<14}{'questions':>10}{'cat drift':>11}{'rules miss':>12}{'url drift':>11}{'no product':>12}{'mean ms':>10}{'p95 ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for category, row in report.items():
+        category_drift, rules_miss, url_drift = (
+            "-" if row[key] is None else f"{row[key]:.0%}"
+            for key in ("category_drift", "rules_miss", "url_drift")
+        )
+        latency_mean, latency_p95 = (
+            "-" if row[key] is None else f"{row[key]:.1f}"
+            for key in ("latency_mean_ms", "latency_p95_ms")
+        )
+        print(
+            f"{category:<14}{row['questions']:>10}{category_drift:>11}{rules_miss:>12}{url_drift:>11}"
+            f"{row['no_product']:>12.0%}{latency_mean:>10}{latency_p95:>10}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=["rules", "live"], default="rules",
+                        help="rules: keyword rules only, no API calls; live: full cascade with OpenAI")
+    parser.add_argument("--model", default="gpt-4o-mini-2024-07-18", help="full model for the live cascade")
+    parser.add_argument("--history-dir", default=chat.CHAT_HISTORY_DIR)
+    parser.add_argument("--shards", type=int, default=chat.CHAT_HISTORY_SHARDS)
+    parser.add_argument("--legacy", help="read this old shelve history file instead of the store")
+    parser.add_argument("--limit", type=int, help="stop after this many questions")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    if args.legacy:
+        messages = iter_legacy_messages(args.legacy)
+    else:
+        messages = iter_store_messages(args.history_dir, args.shards)
+    report = analyze(iter_question_answers(messages), args.mode, args.model, args.limit)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()